@@ -5,15 +5,22 @@ auto_test_emuelec.py
 结果写入 /storage/logs/auto_test/result_YYYYMMDD_HHMMSS.csv
 """
 
+import os
 import time
 import subprocess
 import pathlib
 import re
+import json
+import tempfile
 import xml.etree.ElementTree as ET
 import csv                         # ← 新增，仅用标准库
-from typing import Dict, Iterator, Tuple
+from typing import Dict, Iterable, Iterator, Tuple
 import argparse
 import logging          # ← 新增
+try:
+    import re2 as re_engine        # google-re2：线性时间 DFA 匹配，可选依赖
+except ImportError:
+    re_engine = re
 # ---------------------------------------------------------------------------
 ES_CFG_FILES = [
     pathlib.Path("/storage/.config/emulationstation/es_systems.cfg"),
@@ -22,15 +29,32 @@ ES_CFG_FILES = [
 RUNSCRIPT = "/usr/bin/emuelecRunEmu.sh"
 LOGFILE   = pathlib.Path("/emuelec/logs/runcommand.log")
 OUTDIR    = pathlib.Path("/storage/logs/auto_test")
+# parse_systems 结果缓存：放在仅 root 可写的 OUTDIR 下（勿放 /tmp），纯 JSON，不含可执行内容
+SYS_CACHE = OUTDIR / ".es_systems_cache.json"
 TIMEOUT   = 25
 SLEEP_GAP = 1
-ERROR_PAT = re.compile(r"(ERROR|Error|Failed|Segmentation fault|Traceback)")
+ERROR_WORDS = ("ERROR", "Error", "Failed", "Segmentation fault", "Traceback")
+ERROR_PAT = re_engine.compile("|".join(map(re.escape, ERROR_WORDS)).encode())
+LOG_CHUNK    = 64 * 1024          # 每次从日志读取的字节数
+LOG_SCAN_MAX = 1024 * 1024        # 单个 ROM 最多扫描的新增日志字节数
+RESULT_FMT   = "[%4d/%d] [%s] %-8s %s (%.2fs) %s"   # 每个 ROM 的结果行
+CSV_HEADER   = ("platform", "rom", "core", "emulator", "time(s)", "status", "reason")
+CSV_BUFSIZE  = 1 << 20            # CSV 写缓冲
+CSV_FLUSH_EVERY = 50              # 每写入多少行落盘一次，中途崩溃也能保留已有结果
+
+logger = logging.getLogger(__name__)
 
 # ---------------------------------------------------------------------------
-def parse_systems() -> Dict[str, Dict[str, object]]:
+def parse_systems(only: Iterable[str] | None = None) -> Dict[str, Dict[str, object]]:
     """
     解析 EmulationStation 的 es_systems.cfg，返回平台配置字典。
 
+    Parameters
+    ----------
+    only : 仅返回这些平台（大小写不敏感）；为空时返回全部平台。
+           缓存未命中时仍完整解析并写入缓存，再按 only 过滤，
+           使常用的 -s 重复运行在第二次起即可命中缓存。
+
     返回示例
     -------
     {
@@ -46,35 +70,81 @@ def parse_systems() -> Dict[str, Dict[str, object]]:
     cfg_file: pathlib.Path | None = next((f for f in ES_CFG_FILES if f.exists()), None)
     if cfg_file is None:
         raise FileNotFoundError("未找到 es_systems.cfg，请检查 ES_CFG_FILES 常量设置。")
+    wanted = {s.lower() for s in only} if only else None
+
+    # ---- 配置文件未变化（路径 / mtime / 大小一致）时直接读缓存 ----
+    st = cfg_file.stat()
+    cache_key = (str(cfg_file), st.st_mtime_ns, st.st_size)
+    systems = _load_sys_cache(cache_key)
+    if systems is None:
+        # ---- iterparse 逐个 <system> 处理，处理完即 clear，不构建完整 DOM ----
+        systems = {}
+        for _, node in ET.iterparse(cfg_file, events=("end",)):
+            if node.tag != "system":
+                continue
+            name = node.findtext("name", "").strip()
+            if name:
+                systems[name] = _system_cfg(node)
+            node.clear()
+        if not systems:
+            raise RuntimeError(f"{cfg_file} 未解析到任何 <system> 节点。")
+        _save_sys_cache(cache_key, systems)
+
+    if wanted is None:
+        return systems
+    return {k: v for k, v in systems.items() if k.lower() in wanted}
+
+
+def _system_cfg(node: ET.Element) -> Dict[str, object]:
+    """把单个 <system> 节点转换为 parse_systems 返回的平台配置。"""
+    rom_path = pathlib.Path(node.findtext("path", "").strip()).expanduser()
+    ext_raw  = node.findtext("extension", "").strip()
+    # es_systems.cfg 里的扩展名前可能含点，也可能没有点；统一转成带点的小写
+    exts = [e if e.startswith(".") else f".{e}" for e in ext_raw.split()]
+    exts = [e.lower() for e in exts]
+
+    emulator = node.findtext("emulator", "").strip() or "default"
+    core     = node.findtext("core", "").strip() or "default"
+
+    return {
+        "rom_dir":  rom_path,
+        "ext":      exts,
+        "emulator": emulator,
+        "core":     core,
+    }
 
-    tree = ET.parse(cfg_file)
-    root = tree.getroot()
-
-    systems: Dict[str, Dict[str, object]] = {}
-    for sys in root.findall("system"):
-        name = sys.findtext("name", "").strip()
-        if not name:
-            continue
-
-        rom_path = pathlib.Path(sys.findtext("path", "").strip()).expanduser()
-        ext_raw  = sys.findtext("extension", "").strip()
-        # es_systems.cfg 里的扩展名前可能含点，也可能没有点；统一转成带点的小写
-        exts = [e if e.startswith(".") else f".{e}" for e in ext_raw.split()]
-        exts = [e.lower() for e in exts]
-
-        emulator = sys.findtext("emulator", "").strip() or "default"
-        core     = sys.findtext("core", "").strip() or "default"
-
-        systems[name] = {
-            "rom_dir":  rom_path,
-            "ext":      exts,
-            "emulator": emulator,
-            "core":     core,
-        }
 
-    if not systems:
-        raise RuntimeError(f"{cfg_file} 未解析到任何 <system> 节点。")
-    return systems
+def _load_sys_cache(cache_key: Tuple[str, int, int]) -> Dict[str, Dict[str, object]] | None:
+    """读取 SYS_CACHE；缓存缺失、损坏或 cache_key 不一致时返回 None。"""
+    try:
+        with SYS_CACHE.open("r", encoding="utf-8") as f:
+            key, raw = json.load(f)
+        if key != list(cache_key):
+            return None
+        return {name: dict(cfg, rom_dir=pathlib.Path(cfg["rom_dir"]))
+                for name, cfg in raw.items()}
+    except (OSError, ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+
+def _save_sys_cache(cache_key: Tuple[str, int, int],
+                    systems: Dict[str, Dict[str, object]]) -> None:
+    """
+    把解析结果写入 SYS_CACHE（Path 转为 str），失败时静默忽略。
+    临时文件由 mkstemp 以 O_EXCL 创建，不会跟随预先放置的符号链接。
+    """
+    raw = {name: dict(cfg, rom_dir=str(cfg["rom_dir"])) for name, cfg in systems.items()}
+    try:
+        SYS_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=SYS_CACHE.parent, prefix=f"{SYS_CACHE.name}.")
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump((cache_key, raw), f, ensure_ascii=False)
+        os.replace(tmp, SYS_CACHE)
+    except OSError:
+        pathlib.Path(tmp).unlink(missing_ok=True)
 
 
 # ---------------------------------------------------------------------------
@@ -90,12 +160,69 @@ def iter_roms(systems: Dict[str, Dict[str, object]]) -> Iterator[Tuple[str, path
         rom_dir: pathlib.Path = cfg["rom_dir"]
         if not rom_dir.exists():
             continue
-        for ext in cfg["ext"]:
-            # 使用 rglob 递归遍历，大小写不敏感
-            pattern = f"*{ext}"
-            for rom in rom_dir.rglob(pattern):
-                if rom.is_file():
-                    yield plat, rom
+        for rom in walk_roms(rom_dir, cfg["ext"]):
+            yield plat, rom
+
+
+def walk_roms(rom_dir: pathlib.Path, exts: Iterable[str],
+              ordered: bool = False) -> Iterator[pathlib.Path]:
+    """
+    单次递归遍历 rom_dir，返回扩展名（大小写不敏感）属于 exts 的文件。
+
+    基于 os.scandir：文件类型取自 readdir 返回的 d_type，
+    普通文件与目录无需额外 stat；不跟随目录符号链接，避免环路。
+
+    ordered=True 时每层按名称排序后深度优先遍历，产出顺序与对结果
+    sorted() 一致；调用方只取前 N 个时，其余子目录不会被展开。
+    """
+    ext_tuple = tuple({e.lower() for e in exts})
+    stack: list = [os.fspath(rom_dir)]      # str 为待展开目录，DirEntry 为待产出文件
+    while stack:
+        item = stack.pop()
+        if not isinstance(item, str):
+            yield pathlib.Path(item.path)
+            continue
+        try:
+            with os.scandir(item) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        if ordered:
+            entries.sort(key=lambda e: e.name, reverse=True)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.name.lower().endswith(ext_tuple) and entry.is_file():
+                if ordered:
+                    stack.append(entry)
+                else:
+                    yield pathlib.Path(entry.path)
+
+
+# ---------------------------------------------------------------------------
+def scan_log(offset: int) -> str:
+    """
+    从 offset 处分块扫描 LOGFILE 新增内容，返回首个命中的错误关键字。
+
+    每块之间保留 (最长关键字长度 - 1) 字节，防止关键字跨块被截断；
+    最多扫描 LOG_SCAN_MAX 字节，未命中返回空串。
+    """
+    carry_len = max(map(len, ERROR_WORDS)) - 1
+    carry = b""
+    scanned = 0
+    with LOGFILE.open("rb") as f:
+        f.seek(offset)
+        while scanned < LOG_SCAN_MAX:
+            chunk = f.read(min(LOG_CHUNK, LOG_SCAN_MAX - scanned))
+            if not chunk:
+                break
+            scanned += len(chunk)
+            buf = carry + chunk
+            m = ERROR_PAT.search(buf)
+            if m:
+                return m.group(0).decode()
+            carry = buf[-carry_len:]
+    return ""
 
 
 # ---------------------------------------------------------------------------
@@ -125,7 +252,8 @@ def run_one(plat: str, rom: pathlib.Path, cfg: Dict[str, object]) -> Tuple[str,
     # ---- 调用运行脚本 ----
     cmd = [RUNSCRIPT, plat, str(rom)]
     try:
-        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         proc.wait(timeout=TIMEOUT)
     except subprocess.TimeoutExpired:
         proc.kill()
@@ -139,19 +267,38 @@ def run_one(plat: str, rom: pathlib.Path, cfg: Dict[str, object]) -> Tuple[str,
     status = "PASS"
     try:
         if LOGFILE.exists():
-            with LOGFILE.open("r", encoding="utf-8", errors="ignore") as f:
-                f.seek(log_offset)
-                new_logs = f.read()
-                m = ERROR_PAT.search(new_logs)
-                if m:
-                    status = "FAIL"
-                    reason = m.group(0)
+            reason = scan_log(log_offset)
+            if reason:
+                status = "FAIL"
     except Exception as e:  # noqa: BLE001
         status = "FAIL"
         reason = f"log read error: {e}"
 
     return status, used, reason
 
+# ---------------------------------------------------------------------------
+def run_all(tasks: Iterable[Tuple[str, pathlib.Path]],
+            systems: Dict[str, Dict[str, object]]
+            ) -> Iterator[Tuple[str, pathlib.Path, str, float, str]]:
+    """
+    逐个执行 run_one，边测边返回结果。
+
+    只能串行：判定依赖所有 ROM 共用的 runcommand.log（由启动脚本写入），
+    并发时一个 ROM 的错误会记到同时运行的其他 ROM 上。
+
+    Parameters
+    ----------
+    tasks   : (platform_name, rom_path) 序列
+    systems : 平台配置（parse_systems 返回值）
+
+    Yields
+    ------
+    (platform_name, rom_path, status, used, reason)
+    """
+    for plat, rom in tasks:
+        status, used, reason = run_one(plat, rom, systems[plat])
+        yield plat, rom, status, used, reason
+
 # ---------------------------------------------------------------------------
 # ……（其余函数保持不变，省略）……
 
@@ -182,28 +329,39 @@ def main() -> None:
     init_logger(args.verbose)
 
     OUTDIR.mkdir(parents=True, exist_ok=True)
-    systems = parse_systems()
-
     # ---------- 只保留用户指定的平台 ----------
-    if args.system:
-        lowercase_sel = {s.lower() for s in args.system}
-        systems = {k: v for k, v in systems.items() if k.lower() in lowercase_sel}
-        if not systems:
-            raise SystemExit(f"未找到匹配平台: {', '.join(args.system)}")
+    systems = parse_systems(args.system)
+    if not systems:
+        raise SystemExit(f"未找到匹配平台: {', '.join(args.system)}")
 
     rom_list = list(iter_roms(systems))
     if not rom_list:
         raise SystemExit("未发现任何 ROM，已退出。")
 
     total = len(rom_list)
-    records = []
-
-    for idx, (plat, rom) in enumerate(rom_list, 1):
-        cfg = systems[plat]
-        status, used, reason = run_one(plat, rom, cfg)
-        logging.info("[%4d/%d] [%s] %-8s %s (%.2fs) %s",
-                     idx, total, status, plat, rom.name, used, reason)
-        records.append((plat, rom.name, cfg["core"], cfg["emulator"],
-                        f"{used:.2f}", status, reason))
-
-    # ---- CSV 写入与统计代码保持不变 ----
\ No newline at end of file
+    passed = 0
+    out_path = OUTDIR / f"result_{time.strftime('%Y%m%d_%H%M%S')}.csv"
+    results = run_all(rom_list, systems)
+
+    # ---- 边测试边写 CSV，定期 flush ----
+    with out_path.open("w", newline="", encoding="utf-8", buffering=CSV_BUFSIZE) as fp:
+        writer = csv.writer(fp)
+        writer.writerow(CSV_HEADER)
+
+        log_result = logger.isEnabledFor(logging.INFO)
+        for idx, (plat, rom, status, used, reason) in enumerate(results, 1):
+            cfg = systems[plat]
+            if log_result:
+                logger.info(RESULT_FMT, idx, total, status, plat, rom.name, used, reason)
+            writer.writerow((plat, rom.name, cfg["core"], cfg["emulator"],
+                             f"{used:.2f}", status, reason))
+            if idx % CSV_FLUSH_EVERY == 0:
+                fp.flush()
+            if status == "PASS":
+                passed += 1
+
+    logger.info("完成：PASS %d / FAIL %d，结果已写入 %s", passed, total - passed, out_path)
+
+
+if __name__ == "__main__":
+    main()
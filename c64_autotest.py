@@ -5,7 +5,7 @@ EmuELEC - C64 批量自测脚本
 成功准则：retroarch / vice_x64 / x64_libretro 进程启动后持续 ≥ 5 秒即 PASS
 """
 
-import os, sys, time, csv, signal, subprocess
+import os, re, sys, time, csv, signal, subprocess, functools, argparse, itertools
 from xml.etree import ElementTree as ET
 
 # ============ 基本常量 ============
@@ -21,68 +21,145 @@ ROM_DIR = EXT = CORE = EMULATOR = None  # 运行时自动填充
 def get_sys_info():
     global ROM_DIR, EXT, CORE, EMULATOR
     if ROM_DIR: return
-    tree = ET.parse(CFG_PATH)
-    for node in tree.findall("system"):
+    # 流式解析：每个 <system> 处理完即释放，找到目标后立即停止
+    for _, node in ET.iterparse(CFG_PATH, events=("end",)):
+        if node.tag != "system":
+            continue
         if node.findtext("name") == TARGET_SYSTEM:
             ROM_DIR  = node.findtext("path")
             EXT      = node.findtext("extension").split()
             CORE     = node.find(".//core").text
             EMULATOR = node.find(".//emulator").attrib["name"]
             return
+        node.clear()
     raise RuntimeError("es_systems.cfg 中找不到 C64 条目！")
 
-def parse_gamelist():
+def scan_rom_dir():
+    """直接扫描 ROM_DIR（不解析 gamelist.xml），返回按文件名排序的 [(路径, 名称)]"""
+    get_sys_info()
+    exts = tuple(EXT)
+    with os.scandir(ROM_DIR) as it:
+        names = sorted(e.name for e in it if e.name.endswith(exts) and e.is_file())
+    return [(os.path.join(ROM_DIR, f), f) for f in names]
+
+def iter_gamelist():
+    """
+    流式读取 gamelist.xml，逐个产出 (路径, 名称)。
+    文件缺失或为空时改为扫描目录；解析中途出错（如文件被截断）时
+    用目录扫描补全，已产出的路径不再重复。
+    """
     get_sys_info()
     gl = os.path.join(ROM_DIR, "gamelist.xml")
-    out = []
+    seen = set()
+    broken = False
     if os.path.isfile(gl):
         try:
-            tree = ET.parse(gl)
-            for g in tree.findall("game"):
+            for _, g in ET.iterparse(gl, events=("end",)):
+                if g.tag != "game":
+                    continue
                 p = (g.findtext("path") or "").strip()
                 full = p if p.startswith("/") else os.path.join(ROM_DIR, p.lstrip("./"))
                 name = g.findtext("name") or os.path.basename(full)
-                out.append((full, name))
+                g.clear()
+                seen.add(os.path.normpath(full))
+                yield full, name
         except ET.ParseError:
-            print("[警告] gamelist.xml 解析失败，改为扫描目录")
-    if not out:  # fallback
-        out = [(os.path.join(ROM_DIR, f), f)
-               for f in sorted(os.listdir(ROM_DIR))
-               if any(f.endswith(e) for e in EXT)]
-    return out
-
+            print("[警告] gamelist.xml 解析失败，改为扫描目录补全")
+            broken = True
+    if broken or not seen:  # fallback
+        for full, name in scan_rom_dir():
+            if os.path.normpath(full) not in seen:
+                yield full, name
+
+@functools.lru_cache(maxsize=1)
 def get_controllers():
+    """读取并转义手柄配置；整个批次内文件不变，只读一次"""
     cfg = "/tmp/gamepads.cfg"
     if os.path.isfile(cfg):
-        return open(cfg).read().strip().replace('"', r'\"')
+        with open(cfg) as f:
+            return f.read().strip().replace('"', r'\"')
     return ""
 
 # ============ 进程检测 & 清理 ============
 MATCH_WORDS = ("retroarch", "vice_x64", "x64_libretro")
+MATCH_RE    = re.compile("|".join(MATCH_WORDS).encode())
+_WORDS_B    = tuple(w.encode() for w in MATCH_WORDS)
 
-def _cmdline(pid):
+def _read_proc(pid, name):
     try:
-        with open(f"/proc/{pid}/cmdline", "rb") as f:
-            return f.read().replace(b"\0", b" ").decode("utf-8", "ignore")
-    except FileNotFoundError:
-        return ""
-
-def still_running():
-    return any(any(w in _cmdline(pid) for w in MATCH_WORDS)
-               for pid in os.listdir("/proc") if pid.isdigit())
+        with open(f"/proc/{pid}/{name}", "rb") as f:
+            return f.read()
+    except OSError:
+        return b""
+
+def _is_emulator(pid):
+    # comm 只有一行可执行文件名（最长 15 字节），先用它过滤掉绝大多数进程
+    comm = _read_proc(pid, "comm").strip()
+    if not comm or not any(w.startswith(comm) or comm.startswith(w) for w in _WORDS_B):
+        return False
+    return MATCH_RE.search(_read_proc(pid, "cmdline")) is not None
+
+def _proc_tree(pid):
+    """pid 及其所有子孙进程；内核不支持 /proc/<pid>/task/*/children 时返回 None"""
+    if not os.path.exists(f"/proc/self/task/{os.getpid()}/children"):
+        return None
+    tree, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        tree.append(p)
+        try:
+            with os.scandir(f"/proc/{p}/task") as it:
+                for t in it:
+                    todo.extend(int(c) for c in _read_proc(f"{p}/task/{t.name}", "children").split())
+        except OSError:
+            pass
+    return tree
+
+def _emulator_pids(pids=None):
+    """pids 为空时扫描整个 /proc，否则只检查给定进程"""
+    if pids is None:
+        with os.scandir("/proc") as it:
+            pids = [e.name for e in it if e.name.isdigit()]
+    return [int(p) for p in pids if _is_emulator(p)]
+
+def still_running(pids=None):
+    return bool(_emulator_pids(pids))
+
+def stop_group(proc, grace=5):
+    """SIGINT 结束 proc 所在进程组（脚本 + retroarch + 核心），grace 秒后仍有残留则 SIGKILL 整组"""
+    pgid = proc.pid                      # start_new_session=True，进程组号即 pid
+    try:
+        os.killpg(pgid, signal.SIGINT)
+    except ProcessLookupError:
+        return
+    deadline = time.monotonic() + grace
+    try:
+        proc.wait(grace)                 # 先回收组长，否则僵尸进程会让组一直“存在”
+        while time.monotonic() < deadline:
+            os.killpg(pgid, 0)           # 组内已无进程时抛 ProcessLookupError
+            time.sleep(0.1)
+    except subprocess.TimeoutExpired:
+        pass
+    except ProcessLookupError:
+        return
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    proc.wait()
 
-def wait_until_idle(max_wait=10):
+def wait_until_idle(max_wait=10, pids=None):
     t = 0.0
-    while still_running() and t < max_wait:
+    while still_running(pids) and t < max_wait:
         time.sleep(0.5)
         t += 0.5
-    if still_running():  # 兜底强杀
-        for pid in os.listdir("/proc"):
-            if pid.isdigit() and any(w in _cmdline(pid) for w in MATCH_WORDS):
-                try:
-                    os.kill(int(pid), signal.SIGKILL)
-                except PermissionError:
-                    pass
+    leftovers = _emulator_pids(pids)
+    if leftovers:  # 兜底强杀
+        for pid in leftovers:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except (PermissionError, ProcessLookupError):
+                pass
         time.sleep(1)
 
 # ============ 单 ROM 测试核心 ============
@@ -94,40 +171,57 @@ def run_one(path, name):
            f'--controllers="{get_controllers()}"']
 
     proc = subprocess.Popen(cmd,
+                            stdin=subprocess.DEVNULL,
                             stdout=subprocess.DEVNULL,
-                            stderr=subprocess.STDOUT)
-
-    # 等 CHECK_SEC 秒
-    time.sleep(CHECK_SEC)
+                            stderr=subprocess.STDOUT,
+                            start_new_session=True)
+
+    # 最多等 CHECK_SEC 秒；进程提前退出（秒退）则立即判定
+    deadline = time.monotonic() + CHECK_SEC
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            break
+        time.sleep(0.1)
     alive = (proc.poll() is None)
 
     result = "PASS" if alive else "FAIL"
     detail = f"alive={alive}"
 
-    # 结束进程并清理
-    if alive:
-        proc.send_signal(signal.SIGINT)
-        try:
-            proc.wait(5)
-        except subprocess.TimeoutExpired:
-            proc.kill()
-    wait_until_idle()
+    # 结束整个进程组即可覆盖所有子孙进程，无需扫描 /proc；
+    # 进程树须在组长退出前记录，仅用于检查极少数自行脱离进程组的残留
+    tree = _proc_tree(proc.pid) if alive else None
+    stop_group(proc)
+    if tree:
+        wait_until_idle(pids=tree)
 
     return result, detail
 
 # ============ 主流程 ============
 def main():
+    ap = argparse.ArgumentParser(description="EmuELEC C64 批量自测")
+    ap.add_argument("--source", choices=("disk", "gamelist"), default="disk",
+                    help="ROM 来源：disk 直接扫描 ROM 目录（默认）；gamelist 读取 gamelist.xml")
+    args = ap.parse_args()
+
     if os.geteuid() != 0:
         print("⚠ 建议 root 运行，避免权限/TTY 问题")
-    games = parse_gamelist()
-    if not games:
+    if args.source == "disk":
+        games = scan_rom_dir()
+        total = len(games)
+    else:
+        games = iter_gamelist()   # 边解析边测试，总数未知
+        total = "?"
+    games = iter(games)
+    first = next(games, None)
+    if first is None:
         print("未找到 C64 ROM")
         return
+    wait_until_idle()  # 兜底：清理此前会话遗留的模拟器进程
 
     with open(REPORT_CSV, "w", newline="", encoding="utf-8") as fp:
         w = csv.writer(fp); w.writerow(["rom", "name", "result", "detail"])
-        for i, (p, n) in enumerate(games, 1):
-            print(f"[{i}/{len(games)}] {n} …", end="", flush=True)
+        for i, (p, n) in enumerate(itertools.chain([first], games), 1):
+            print(f"[{i}/{total}] {n} …", end="", flush=True)
             res, info = run_one(p, n)
             w.writerow([p, n, res, info])
             print(res)
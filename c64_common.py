@@ -0,0 +1,165 @@
+"""
+C64 游戏启动公共模块
+-------------------
+• 先直接把 .zip 交给 RetroArch + VICE；
+• 若进程在 very_short_secs 内退出（认为“秒退”）或返回码非 0，
+  则把 ZIP 解压出来，依次尝试包里所有受支持镜像，
+  直到成功或全部失败为止。
+"""
+from __future__ import annotations   # ← 该导入只能出现一次并位于文件最前
+
+import functools
+import io
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+RETROARCH_BIN: str = "retroarch"
+VICE_CORE: str = "/tmp/cores/vice_x64_libretro.so"
+RETROARCH_CFG: str = "/storage/.config/retroarch/retroarch.cfg"
+
+# 小于这个耗时就被视为“秒退”
+very_short_secs: float = 3.0
+
+# RetroArch-VICE 可加载的镜像扩展名
+SUPPORTED_EXTS: tuple[str, ...] = (
+    ".d64", ".t64", ".tap", ".prg", ".g64",
+    ".crt", ".p00", ".d71", ".d81",
+)
+
+# 解压镜像时的读写缓冲（SD 卡 / USB 上大块顺序 I/O 明显更快）
+COPY_BUFSIZE: int = 1 << 20
+
+
+# -------- 工具函数 -------------------------------------------------
+def build_retroarch_cmd(content_path: str) -> List[str]:
+    """
+    生成 RetroArch 启动命令
+    retroarch -v -L <core> --config <cfg> <content>
+    """
+    return [
+        RETROARCH_BIN,
+        "-v",
+        "-L", VICE_CORE,
+        "--config", RETROARCH_CFG,
+        content_path,
+    ]
+
+
+def _run_process(cmd: List[str]) -> tuple[int, float]:
+    """运行子进程并返回 (退出码, 运行秒数)"""
+    start = time.monotonic()
+    proc = subprocess.run(cmd, stdin=subprocess.DEVNULL)
+    return proc.returncode, time.monotonic() - start
+
+
+def _extract_supported_images(zippath: Path) -> Iterator[tuple[int, int, Path]]:
+    """
+    按 zip 内原顺序逐个解压受支持的镜像，每次产出 (序号, 总数, 绝对路径)。
+    调用方停止迭代后，剩余镜像不会再被解压。
+    若 zip 不是合法文件、找不到镜像，或仅含一个位于根目录的镜像
+    （与直接加载 zip 等价，重试无意义）则不产出任何结果。
+    """
+    raw = io.BufferedReader(io.FileIO(zippath), buffer_size=COPY_BUFSIZE)
+    try:
+        zf = zipfile.ZipFile(raw)
+    except zipfile.BadZipFile:
+        raw.close()
+        return
+    with raw, zf:
+        members = [info for info in zf.infolist()
+                   if not info.is_dir()
+                   and info.filename.lower().endswith(SUPPORTED_EXTS)]
+        if len(members) == 1 and "/" not in members[0].filename:
+            return
+        tmpdir = Path(tempfile.mkdtemp(prefix="c64roms_"))
+        for idx, info in enumerate(members, 1):
+            out_path = tmpdir / Path(info.filename).name
+            with zf.open(info) as src, out_path.open("wb") as dst:
+                shutil.copyfileobj(src, dst, length=COPY_BUFSIZE)
+            yield idx, len(members), out_path
+
+
+# -------- 公开函数 -------------------------------------------------
+def run_c64_game(rom_path: str, dry_run: bool = False) -> int:
+    """
+    使用 RetroArch + VICE 核心启动指定 ROM。
+    • rom_path  可以是 .zip/.d64/.t64 … 等
+    • dry_run   为 True 时仅打印命令，不真正执行（调试）
+    返回值：RetroArch 进程退出码（0 为成功）
+    """
+    # 调用方（list_roms 等）给出的已是绝对路径；这里只做纯字符串的补全，
+    # 不再 resolve() 逐级 lstat 解析符号链接
+    rom_abs = Path(os.path.abspath(os.path.expanduser(rom_path)))
+    if not os.path.exists(rom_abs):
+        raise FileNotFoundError(f"ROM 文件不存在: {rom_abs}")
+
+    # ---------- 尝试 #1：直接启动 ZIP / 镜像 ----------
+    cmd = build_retroarch_cmd(str(rom_abs))
+    print("[INFO] 尝试 #1:", shlex.join(cmd))
+    if dry_run:
+        return 0
+
+    code, dur = _run_process(cmd)
+    if code == 0 and dur > very_short_secs:
+        return code  # 第一次就成功
+
+    print(f"[WARN] #1 失败 (code={code}, {dur:.2f}s)，准备解压兜底…")
+
+    # ---------- 尝试 #2：解压 ZIP，逐一尝试（上一张失败才解压下一张） ----------
+    tried = 0
+    for idx, total, img in _extract_supported_images(rom_abs):
+        tried = idx
+        cmd2 = build_retroarch_cmd(str(img))
+        print(f"[INFO] 尝试 #2-{idx}/{total}:", shlex.join(cmd2))
+        code2, dur2 = _run_process(cmd2)
+        print(f"        → 结束 (code={code2}, {dur2:.2f}s)")
+        if code2 == 0 and dur2 > very_short_secs:
+            print("[OK] 成功启动！")
+            return 0
+
+    if not tried:
+        print("[ERROR] ZIP 中未找到可另行尝试的镜像，放弃。")
+        return code or 1
+
+    print("[ERROR] 全部镜像尝试完仍失败")
+    return 1
+
+
+# -------- 系统名识别 -----------------------------------------------
+# 依次尝试匹配的关键字，顺序代表优先级
+C64_KEYWORDS: Tuple[str, ...] = (
+    "c64",
+    "commodore64",
+    "commodore 64",
+    "commodore_64",
+    "vice",     # RetroArch/EmuELEC 默认的 VICE 核心
+    "x64",      # VICE 的主执行文件名
+)
+
+
+def find_c64_name(systems: Dict[str, dict]) -> Optional[str]:
+    """
+    在 es_systems.cfg 解析结果中，找到第一个与 C64 相关的系统名称。
+    兼容常见写法：c64 / commodore64 / commodore 64 / vice / x64 等。
+    """
+    return _find_c64_name(tuple(systems))
+
+
+@functools.lru_cache(maxsize=8)
+def _find_c64_name(names: Tuple[str, ...]) -> Optional[str]:
+    """find_c64_name 的缓存实现；以有序的系统名元组为键，保证优先级稳定。"""
+    lower_map = {name.lower(): name for name in names}
+
+    # 逐个关键字查找，命中后返回原始大小写形式的系统名
+    for kw in C64_KEYWORDS:
+        for sys_lower, sys_orig in lower_map.items():
+            if kw in sys_lower:
+                return sys_orig
+    return None
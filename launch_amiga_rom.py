@@ -6,29 +6,50 @@ amiga_batch_test.py
 启动方式完全等价于 EmulationStation：
     emuelecRunEmu.sh <ROM> -Pamiga --core=puae --emulator=libretro --controllers="..."
 判定：
-    • RetroArch/PUAE 进程在 90 s 检查点仍存活
+    • RetroArch/PUAE 进程在检查点仍存活（最长 WAIT_SEC；CPU 先忙后闲视为已进入游戏，提前判定）
     • 同期日志中未出现 “Segmentation fault / Guru Meditation / panic”
 结果写入 /storage/roms/amiga/test_report.csv
 """
 
-import os, time, csv, signal, subprocess, tempfile, re
+import os, time, signal, tempfile, re, argparse, threading, functools, hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from operator import attrgetter
 from pathlib import Path
-from xml.etree import ElementTree as ET
+
+# 可选的高速匹配引擎：hyperscan（多字面量 DFA）> google-re2 > 标准库 re
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+try:
+    import re2 as re_engine
+except ImportError:
+    re_engine = re
 
 # ───────────────── 可调常量 ─────────────────
 TARGET_SYS  = "amiga"
 ROM_DIR     = Path("/storage/roms/amiga")
 EMU_SH      = "/usr/bin/emuelecRunEmu.sh"
 CORE        = "puae"               # 与 es_systems.cfg 保持一致
-WAIT_SEC    = 10                   # 等足 WHDLoad 解包 + 初始化
+WAIT_SEC    = 10                   # 等足 WHDLoad 解包 + 初始化（上限）
+MIN_WAIT_SEC = 3                   # 至少观察这么久才允许提前判定，留给早期崩溃暴露
+STABLE_WIN  = 0.5                  # CPU 采样窗口（秒）
+STABLE_CPU  = 0.2                  # 窗口内 CPU 占用（单核比例）：先高于此值（启动中）再回落到其下，视为启动完成
 REPORT_CSV  = ROM_DIR / "test_report.csv"
+EXTS        = frozenset({".zip", ".adf", ".lha", ".adz"})
 
 BAD_PATTERNS = [r"segmentation fault", r"guru meditation", r"panic"]
-BAD_RE = re.compile("|".join(BAD_PATTERNS), re.I)
+BAD_RE = re_engine.compile(("(?i)" + "|".join(BAD_PATTERNS)).encode())   # 直接匹配 bytes，免去解码
+BAD_KEEP = max(map(len, BAD_PATTERNS)) - 1   # 跨块保留字节，防止关键字被截断
+POLL_SEC = 0.1
+CSV_BATCH = 16                     # 报告每攒够这么多行写一次
+CLK_TCK = os.sysconf("SC_CLK_TCK")
 
 PROC_KEYS = ("retroarch", "puae_libretro", "puae2021", "uae")
+PROC_RE = re_engine.compile("|".join(map(re.escape, PROC_KEYS)).encode())   # 一次扫描匹配全部关键字
 
 # ───────────────── 工具函数 ─────────────────
+@functools.lru_cache(maxsize=1)
 def controllers_arg() -> str:
     """生成 --controllers="..." 字符串；若文件不存在则返回空串参数"""
     cfg_file = Path("/tmp/gamepads.cfg")
@@ -38,77 +59,322 @@ def controllers_arg() -> str:
         return f'--controllers="{ctl}"'
     return '--controllers=""'
 
+@functools.lru_cache(maxsize=1)
+def cmd_template() -> tuple:
+    """启动命令模板，第 2 项（ROM 路径）留空；整个批次只生成一次"""
+    return (EMU_SH, None,
+            f"-P{TARGET_SYS}",
+            f"--core={CORE}",
+            "--emulator=libretro",
+            controllers_arg())
+
+@functools.lru_cache(maxsize=1)
+def log_dir() -> Path:
+    """本批次的失败日志目录，只创建一次；之后每个 ROM 直接拼路径，免去 mkstemp 的探测"""
+    return Path(tempfile.mkdtemp(prefix="puae_batch_"))
+
 def all_roms():
-    exts = {".zip", ".adf", ".lha", ".adz"}
-    return sorted([p for p in ROM_DIR.iterdir() if p.suffix.lower() in exts])
+    """逐个产出 ROM_DIR 下的 ROM；os.scandir 的 d_type 免去逐文件 stat"""
+    with os.scandir(ROM_DIR) as it:
+        for entry in it:
+            name = entry.name
+            dot = name.rfind(".")
+            if dot > 0 and name[dot:].lower() in EXTS and entry.is_file():
+                yield Path(entry.path)
 
-def _cmdline(pid):
+def _read_bytes(path, size=4096):
+    """读取 /proc 下小文件的原始字节（不解码）；进程已退出时返回空串"""
     try:
-        with open(f"/proc/{pid}/cmdline", "rb") as f:
-            return f.read().replace(b"\0", b" ").decode(errors="ignore")
-    except FileNotFoundError:
-        return ""
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return b""
+    try:
+        return os.read(fd, size)
+    except OSError:
+        return b""
+    finally:
+        os.close(fd)
+
+def _cmdline(pid):
+    """/proc/<pid>/cmdline 原始字节（参数间以 NUL 分隔）"""
+    return _read_bytes(f"/proc/{pid}/cmdline")
+
+# children 文件需要内核 CONFIG_PROC_CHILDREN；不支持时改按进程组查找
+_HAS_CHILDREN = os.path.exists(f"/proc/self/task/{os.getpid()}/children")
+
+def _children(pid):
+    """pid 的直接子进程号，读 /proc/<pid>/task/<pid>/children 单个小文件"""
+    return [int(c) for c in _read_bytes(f"/proc/{pid}/task/{pid}/children").split()]
+
+def _emulator_in_group(pgrp):
+    """退路：扫描 /proc/*/stat，找进程组 pgrp 中 comm 命中 PROC_KEYS 的进程"""
+    with os.scandir("/proc") as it:
+        for e in it:
+            if not e.name.isdigit():
+                continue
+            # 格式 "pid (comm) state ppid pgrp ..."；comm 可能含空格/括号，取最后一个 ")"
+            head, _, rest = _read_bytes(f"/proc/{e.name}/stat", 512).rpartition(b")")
+            fields = rest.split()
+            if (len(fields) > 2 and int(fields[2]) == pgrp
+                    and PROC_RE.search(head.partition(b"(")[2])):
+                return int(e.name)
+    return None
+
+def emulator_pid(root):
+    """
+    root 及其子孙进程中 comm 命中 PROC_KEYS 的进程号，没有则返回 None。
+    模拟器通常由启动脚本派生；脚本直接 exec 模拟器时 root 本身即是。
+    root 以 setsid 启动，进程组号即 root，内核不支持 children 文件时按进程组查找。
+    """
+    if not _HAS_CHILDREN:
+        return _emulator_in_group(root)
+    todo = [root]
+    while todo:
+        pid = todo.pop()
+        if PROC_RE.search(_read_bytes(f"/proc/{pid}/comm", 64)):
+            return pid
+        todo.extend(_children(pid))
+    return None
 
 def kill_leftovers():
-    for pid in os.listdir("/proc"):
-        if pid.isdigit() and any(k in _cmdline(pid) for k in PROC_KEYS):
-            try: os.kill(int(pid), signal.SIGKILL)
-            except PermissionError:
-                pass
+    """全量扫描 /proc 强杀模拟器进程，仅用于启动前的兜底清理"""
+    self_pid = str(os.getpid())   # 脚本路径可能含 "uae" 等关键字，勿误杀自身
+    with os.scandir("/proc") as it:
+        for e in it:
+            if not e.name.isdigit() or e.name == self_pid:
+                continue
+            if PROC_RE.search(_cmdline(e.name)):
+                try: os.kill(int(e.name), signal.SIGKILL)
+                except (PermissionError, ProcessLookupError):
+                    pass
 
-# ───────────────── 单 ROM 测试 ─────────────────
-def test_rom(rom: Path):
-    fd, log_path = tempfile.mkstemp(prefix="puae_", suffix=".log")
-    os.close(fd)
+if hyperscan is not None:
+    _HS_DB = hyperscan.Database()
+    _HS_DB.compile(expressions=[p.encode() for p in BAD_PATTERNS],
+                   ids=list(range(len(BAD_PATTERNS))),
+                   elements=len(BAD_PATTERNS),
+                   flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SINGLEMATCH]
+                         * len(BAD_PATTERNS))
+    _HS_LOCK = threading.Lock()   # 同一 Database 的 scratch 不能被多个线程同时使用
+
+    def _hs_stop(*_):
+        return True               # 命中即终止扫描（scan 抛出 ScanTerminated）
+
+    def has_bad(buf):
+        try:
+            with _HS_LOCK:
+                _HS_DB.scan(buf, match_event_handler=_hs_stop)
+        except hyperscan.ScanTerminated:
+            return True
+        return False
+else:
+    def has_bad(buf):
+        return BAD_RE.search(buf) is not None
 
-    cmd = [
-        EMU_SH, str(rom),
-        f"-P{TARGET_SYS}",
-        f"--core={CORE}",
-        "--emulator=libretro",
-        controllers_arg()
-    ]
+def _drain(fd, out, tail):
+    """
+    读完非阻塞管道 fd 中当前可读的输出，追加到 out 并检查错误关键字。
+    返回 (是否命中, 末尾保留字节)；tail 为上次保留的字节。
+    """
+    while True:
+        try:
+            chunk = os.read(fd, 1 << 16)
+        except BlockingIOError:
+            return False, tail
+        if not chunk:             # EOF
+            return False, tail
+        out += chunk
+        buf = tail + chunk
+        if has_bad(buf):
+            return True, b""
+        tail = buf[-BAD_KEEP:]
 
-    with open(log_path, "w") as lf:
-        proc = subprocess.Popen(cmd, stdout=lf, stderr=subprocess.STDOUT)
+def _spawn(cmd):
+    """
+    用 posix_spawn（vfork+exec，不复制解释器页表）启动 cmd：新会话、stdin 为 /dev/null，
+    stdout/stderr 接到管道；返回 (pid, 非阻塞的管道读端)。
+    Python 启动时忽略了 SIGPIPE / SIGXFSZ，posix_spawn 不会像 Popen 那样自动恢复，需显式重置为默认。
+    """
+    r, w = os.pipe()
+    try:
+        pid = os.posix_spawn(cmd[0], cmd, os.environ, file_actions=[
+            (os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),
+            (os.POSIX_SPAWN_DUP2, w, 1),
+            (os.POSIX_SPAWN_DUP2, w, 2),
+        ], setsid=True, setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+    except BaseException:
+        os.close(r)
+        raise
+    finally:
+        os.close(w)
+    os.set_blocking(r, False)
+    return pid, r
 
-    time.sleep(WAIT_SEC)
-    alive = proc.poll() is None
+def _poll(pid):
+    """非阻塞检查子进程是否已退出（退出则顺带回收）"""
+    try:
+        done, _ = os.waitpid(pid, os.WNOHANG)
+    except ChildProcessError:
+        return True
+    return done != 0
 
-    with open(log_path, "r", errors="ignore") as lf:
-        bad = bool(BAD_RE.search(lf.read()))
+def _open_stat(pid):
+    """常开 /proc/<pid>/stat；fd 绑定该进程实例，pid 被复用后读取会失败而不会读错进程"""
+    if pid is None:
+        return None
+    try:
+        return os.open(f"/proc/{pid}/stat", os.O_RDONLY)
+    except OSError:
+        return None
 
-    result = "PASS" if (alive and not bad) else "FAIL"
-    detail = f"alive={alive} bad={bad} log={Path(log_path).name}"
+def _cpu_ticks(fd):
+    """从常开的 stat fd 重读 utime+stime（时钟滴答）；进程已退出返回 None"""
+    try:
+        buf = os.pread(fd, 512, 0)
+    except OSError:
+        return None
+    fields = buf.rpartition(b")")[2].split()   # state 起算，utime/stime 为第 11/12 项
+    return int(fields[11]) + int(fields[12]) if len(fields) > 12 else None
 
-    if alive:
-        proc.send_signal(signal.SIGINT)
-        try: proc.wait(5)
-        except subprocess.TimeoutExpired: proc.kill()
+# ───────────────── 单 ROM 测试 ─────────────────
+def test_rom(rom: Path):
+    cmd = list(cmd_template())
+    cmd[1] = str(rom)
 
-    kill_leftovers()
-    return result, detail
+    # 输出直接走管道在内存中扫描，不先写 SD 卡再读回；
+    # 独立会话：进程组号即 pid，结束时只清理本 ROM 的进程树，不误杀并行的其他 ROM
+    pid, fd = _spawn(cmd)
+
+    # 等待期间持续扫描新增输出：进程退出或出现错误关键字即提前结束；
+    # 模拟器（启动脚本的子孙进程）CPU 先忙后闲说明已进入游戏循环，也提前结束；
+    # 只闲不忙可能仍在等 I/O 解包，不能据此放行。
+    # 管道读端保持打开直到 kill_group 结束，否则判定前子进程写输出会被 SIGPIPE 杀掉而误判 FAIL
+    out, tail = bytearray(), b""
+    start = time.monotonic()
+    deadline = start + WAIT_SEC
+    stat_fd = win_t = win_ticks = None
+    busy = False                  # 是否已观察到高 CPU 窗口
+    exited = False                # 脚本是否已被 waitpid 回收，kill_group 据此决定是否还需 wait
+    next_find = start             # 查找模拟器进程的节流：每 STABLE_WIN 秒最多一次
+    try:
+        while True:
+            exited = _poll(pid)
+            bad, tail = _drain(fd, out, tail)
+            now = time.monotonic()
+            if bad or exited or now >= deadline:
+                break
+            if stat_fd is None:
+                if now < next_find:
+                    time.sleep(POLL_SEC)
+                    continue
+                next_find = now + STABLE_WIN
+                stat_fd = _open_stat(emulator_pid(pid))
+                if stat_fd is not None:
+                    win_t, win_ticks = now, _cpu_ticks(stat_fd)
+            elif now - win_t >= STABLE_WIN:
+                ticks = _cpu_ticks(stat_fd)
+                if ticks is None or win_ticks is None:
+                    # 模拟器进程已退出或被替换：下一轮重新查找，重新观察
+                    os.close(stat_fd)
+                    stat_fd, busy = None, False
+                else:
+                    if (ticks - win_ticks) / CLK_TCK >= STABLE_CPU * (now - win_t):
+                        busy = True
+                    elif busy and now - start >= MIN_WAIT_SEC:
+                        break
+                    win_t, win_ticks = now, ticks
+            time.sleep(POLL_SEC)
+        # 已回收的 pid 不能再 waitpid（可能已被并行的其他 ROM 复用），只在未退出时复查
+        exited = exited or _poll(pid)
+        # 启动脚本还在不够，其子孙中须有模拟器进程（retroarch 等）存活；此刻定向读取，不用旧快照
+        alive = not exited and emulator_pid(pid) is not None
+
+        result = "PASS" if (alive and not bad) else "FAIL"
+        log_path = "-"
+        if result == "FAIL":      # 仅失败时落盘，便于事后排查
+            # 附加文件全名的短哈希：同名不同扩展（x.adf / x.zip）不会互相覆盖
+            tag = hashlib.blake2b(rom.name.encode(), digest_size=4).hexdigest()
+            log_path = log_dir() / f"{rom.stem}-{tag}.log"
+            log_path.write_bytes(out)
+    finally:
+        # 无论判定或写日志是否出错，都清理本 ROM 的整个进程组
+        try:
+            kill_group(pid, exited)
+        finally:
+            os.close(fd)
+            if stat_fd is not None:
+                os.close(stat_fd)
+    return result, alive, bad, log_path   # 各项单独成列，由 csv.writer 统一格式化
+
+def kill_group(pid, exited=False):
+    """SIGINT 整个进程组，等脚本退出（最多 5 秒）后 SIGKILL 组内残留；exited 表示脚本已被回收"""
+    try:
+        os.killpg(pid, signal.SIGINT)
+    except ProcessLookupError:
+        pass
+    deadline = time.monotonic() + 5
+    while not exited and time.monotonic() < deadline:
+        exited = _poll(pid)
+        if not exited:
+            time.sleep(POLL_SEC)
+    try: os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    if not exited:
+        os.waitpid(pid, 0)
 
 # ───────────────── 主流程 ─────────────────
 def main():
+    import csv                    # 仅写报告时用到，不拖慢模块导入
+    ap = argparse.ArgumentParser(description="EmuELEC Amiga ROM 批量测试")
+    ap.add_argument("-j", "--jobs", type=int, default=1,
+                    help="同时运行的模拟器数量（默认 1，串行）")
+    args = ap.parse_args()
+
     if os.geteuid() != 0:
         print("⚠ 建议以 root 身份运行，避免权限/TTY 问题")
 
-    roms = all_roms()
+    # 按文件名顺序提交；串行时报告即按文件名排序，-j > 1 时按完成顺序写入
+    roms = sorted(all_roms(), key=attrgetter("name"))
     if not roms:
         print("未在", ROM_DIR, "找到任何 ROM"); return
 
-    with REPORT_CSV.open("w", newline="", encoding="utf-8") as fp:
+    # 仅在开始前全量扫描一次 /proc，清理此前会话遗留的模拟器；
+    # 之后每个 ROM 都由 kill_group 按进程组精确清理
+    kill_leftovers()
+    log_dir()                     # 在线程池启动前创建，避免并发首次调用时各建一个目录
+
+    # ROM 名可能含非 ASCII 字符，编码保持 utf-8
+    with REPORT_CSV.open("w", newline="", encoding="utf-8", buffering=1 << 16) as fp:
         writer = csv.writer(fp)
-        writer.writerow(["rom", "result", "detail"])
+        writer.writerow(("rom", "result", "alive", "bad", "log"))
 
-        for i, rom in enumerate(roms, 1):
-            print(f"[{i}/{len(roms)}] {rom.name} …", end="", flush=True)
-            res, info = test_rom(rom)
-            writer.writerow([rom.name, res, info])
-            print(res)
+        # 模拟器是独立进程，线程只负责等待，GIL 不是瓶颈；结果在主线程写入，无需加锁
+        rows = []
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+                futures = {pool.submit(test_rom, rom): rom for rom in roms}
+                try:
+                    for i, fut in enumerate(as_completed(futures), 1):
+                        rom = futures[fut]
+                        try:
+                            row = (rom.name, *fut.result())
+                        except Exception as e:   # 单个 ROM 出错只记一行（异常记在 log 列），不中断整批
+                            row = (rom.name, "ERROR", "-", "-", f"{type(e).__name__}: {e}")
+                        rows.append(row)
+                        print(f"[{i}/{len(roms)}] {rom.name} … {row[1]}")
+                        if len(rows) >= CSV_BATCH:   # 攒够一批再写，避免与模拟器启动的 I/O 交错
+                            writer.writerows(rows)
+                            rows.clear()
+                except BaseException:
+                    # 如 Ctrl-C：取消尚未开始的 ROM，退出 with 时只等正在运行的几个
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    raise
+        finally:
+            writer.writerows(rows)    # 中途异常也写出已完成的结果
 
     print("\n✓ 测试完成，结果已写入:", REPORT_CSV)
+    print("  失败日志目录:", log_dir())
 
 if __name__ == "__main__":
     main()